@@ -0,0 +1,302 @@
+"""GitHub API helpers shared by the sync scripts: token rotation, rate limit pacing, retries, the response cache and
+the ledger of completed writes."""
+import sys
+import atexit
+import time
+import collections
+import contextlib
+import hashlib
+import asyncio
+import sqlite3
+import logging
+import logging.handlers
+import argparse
+import queue
+from typing import AsyncIterator, Optional
+import httpx
+import orjson
+from aiolimiter import AsyncLimiter
+import tenacity
+
+API_URL = "https://api.github.com"
+GRAPHQL_URL = f"{API_URL}/graphql"
+
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+# Once a token has fewer than this many requests left, it's set aside until its rate limit resets
+RATE_LIMIT_THRESHOLD = 100
+
+# These are set by setup() from the command line arguments
+options: argparse.Namespace
+api_semaphore: asyncio.Semaphore
+cache: sqlite3.Connection
+
+
+def setup(args: argparse.Namespace):
+    """Set up logging, the request limit and the cache file from the command line arguments that both scripts share."""
+    global options, api_semaphore, cache
+    options = args
+
+    # Setup logging. The handlers run on a background thread so that writing the log never blocks the migration.
+    file_handler = logging.FileHandler(args.log_file)
+    file_handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+    log_queue = queue.SimpleQueue()
+    log_listener = logging.handlers.QueueListener(log_queue, file_handler, logging.StreamHandler(sys.stdout))
+    logging.basicConfig(level=logging.INFO, format="%(message)s", handlers=[logging.handlers.QueueHandler(log_queue)])
+    log_listener.start()
+    atexit.register(log_listener.stop)
+
+    # httpx logs every request at INFO
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+
+    # Limits the number of API requests in flight at once
+    api_semaphore = asyncio.Semaphore(args.max_threads)
+
+    # GET responses are cached by URL and revalidated with If-None-Match/If-Modified-Since on every request.
+    # GitHub doesn't count 304 responses against the rate limit, so unchanged data is nearly free on re-runs.
+    cache = sqlite3.connect(args.cache_file)
+    cache.execute("CREATE TABLE IF NOT EXISTS responses (url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, link TEXT, body BLOB)")
+
+    # Keys of the writes that have succeeded, so that a re-run after a failure doesn't repeat them
+    cache.execute("CREATE TABLE IF NOT EXISTS done (k TEXT PRIMARY KEY)")
+
+
+class TokenPool(httpx.Auth):
+    """Rotates requests across one or more tokens, setting aside any token whose rate limit is nearly used up until it resets."""
+
+    def __init__(self, tokens: list[str]):
+        self.tokens = collections.deque(tokens)
+        # When each (token, rate limit resource) pair that is nearly used up resets
+        self.exhausted_until: dict[tuple[str, str], float] = {}
+        # GitHub's secondary rate limits allow about 80 content-creating requests per minute per user
+        self.write_limiter = AsyncLimiter(80 * len(tokens), 60)
+
+    @staticmethod
+    def resource(request: httpx.Request) -> str:
+        return "graphql" if request.url.path == "/graphql" else "core"
+
+    def is_exhausted(self, token: str, resource: str) -> bool:
+        return self.exhausted_until.get((token, resource), 0) > time.time()
+
+    def pick(self, resource: str) -> str:
+        for _ in range(len(self.tokens)):
+            token = self.tokens[0]
+            self.tokens.rotate(-1)
+            if not self.is_exhausted(token, resource):
+                return token
+        # Every token is used up, so go with the one that resets first
+        return min(self.tokens, key=lambda token: self.exhausted_until[(token, resource)])
+
+    async def wait_for_quota(self, request: httpx.Request):
+        """If every token is nearly out of requests, sleep until the first of them resets."""
+        resource = self.resource(request)
+        if all(self.is_exhausted(token, resource) for token in self.tokens):
+            reset = min(self.exhausted_until[(token, resource)] for token in self.tokens)
+            logging.warning("Rate limit nearly used up for all tokens; waiting %d seconds", reset - time.time())
+            await asyncio.sleep(max(reset - time.time(), 0) + 1)
+
+    def auth_flow(self, request: httpx.Request):
+        resource = self.resource(request)
+        for _ in range(len(self.tokens)):
+            token = self.pick(resource)
+            request.headers["Authorization"] = f"token {token}"
+            response = yield request
+
+            remaining = response.headers.get("X-RateLimit-Remaining")
+            if remaining is not None and int(remaining) < RATE_LIMIT_THRESHOLD:
+                self.exhausted_until[(token, response.headers.get("X-RateLimit-Resource", resource))] = float(response.headers["X-RateLimit-Reset"])
+
+            # GraphQL reports its rate limit in a 200 response, whose body isn't read at this point. A query is
+            # safe to resend, so any GraphQL response from a token with nothing left is retried with the next one.
+            if remaining != "0" or not (response.status_code in (403, 429) or resource == "graphql"):
+                return
+            # A streamed body (such as an asset upload) has already been consumed and can't be resent
+            if not isinstance(request.stream, httpx.ByteStream):
+                return
+
+
+def create_client(tokens: str) -> httpx.AsyncClient:
+    # Tolerate spaces around the commas and a stray trailing comma
+    token_list = [token.strip() for token in tokens.split(",") if token.strip()]
+    if not token_list:
+        raise ValueError("No GitHub token given")
+    return httpx.AsyncClient(base_url=API_URL,
+                             http2=True,
+                             follow_redirects=True,
+                             limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+                             timeout=60,
+                             auth=TokenPool(token_list),
+                             headers={
+                                 "Accept": "application/vnd.github+json",
+                                 "X-GitHub-Api-Version": "2022-11-28",
+                             })
+
+
+# Statuses that GitHub returns for server problems that go away on their own
+SERVER_ERROR_STATUSES = {500, 502, 503, 504}
+
+# Errors that mean the request never reached GitHub, so it's safe to send again whatever it does
+NOT_SENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+def is_rate_limited(response: httpx.Response) -> bool:
+    """Whether GitHub turned the request away because of a primary or secondary rate limit."""
+    if response.status_code == 429:
+        return True
+    # GraphQL reports its primary rate limit as an error in an otherwise successful response
+    if response.is_success:
+        return response.request.url.path == "/graphql" and response.headers.get("X-RateLimit-Remaining") == "0" and \
+            any(error.get("type") == "RATE_LIMITED" for error in orjson.loads(response.content).get("errors") or [])
+    if response.status_code != 403:
+        return False
+    if "Retry-After" in response.headers or response.headers.get("X-RateLimit-Remaining") == "0":
+        return True
+    # Secondary rate limits don't always come with either header, but their message always names them
+    try:
+        return b"secondary rate limit" in response.content.lower()
+    except httpx.ResponseNotRead:
+        return False
+
+
+def is_idempotent(request: httpx.Request) -> bool:
+    """Whether sending the request twice has the same effect as sending it once. The GraphQL requests are all queries."""
+    return request.method in ("GET", "PATCH") or request.url.path == "/graphql"
+
+
+def is_transient(exception: BaseException) -> bool:
+    if isinstance(exception, NOT_SENT_ERRORS):
+        return True
+    if isinstance(exception, httpx.HTTPStatusError) and is_rate_limited(exception.response):
+        return True
+    # Anything else may have failed after GitHub acted on the request. Resending a POST could then create a
+    # second issue, comment or release, and a duplicate issue throws every later issue number off by one.
+    if isinstance(exception, httpx.TransportError):
+        return is_idempotent(exception.request)
+    if isinstance(exception, httpx.HTTPStatusError):
+        return exception.response.status_code in SERVER_ERROR_STATUSES and is_idempotent(exception.request)
+    return False
+
+
+exponential_backoff = tenacity.wait_exponential_jitter()
+
+# GitHub asks for a wait of at least a minute after a rate limit that doesn't say how long to wait, growing
+# exponentially if it keeps happening
+rate_limit_backoff = tenacity.wait_exponential(multiplier=60, max=600)
+
+
+def wait_for_retry(retry_state: tenacity.RetryCallState) -> float:
+    """Wait as long as GitHub asks us to after a rate limit, otherwise back off exponentially."""
+    exception = retry_state.outcome.exception()
+    if isinstance(exception, httpx.HTTPStatusError) and is_rate_limited(exception.response):
+        headers = exception.response.headers
+        if "Retry-After" in headers:
+            return float(headers["Retry-After"])
+        if headers.get("X-RateLimit-Remaining") == "0":
+            return max(float(headers["X-RateLimit-Reset"]) - time.time(), 0) + 1
+        return rate_limit_backoff(retry_state)
+    return exponential_backoff(retry_state)
+
+
+retry_transient = tenacity.retry(retry=tenacity.retry_if_exception(is_transient),
+                                 wait=wait_for_retry,
+                                 stop=tenacity.stop_after_attempt(6),
+                                 before_sleep=tenacity.before_sleep_log(logging.getLogger(), logging.WARNING),
+                                 reraise=True)
+
+
+@retry_transient
+async def gh_request(client: httpx.AsyncClient, method: str, url: str, **kwargs) -> httpx.Response:
+    request = client.build_request(method, url, **kwargs)
+
+    cached = None
+    if method == "GET":
+        cached = cache.execute("SELECT etag, last_modified, link, body FROM responses WHERE url = ?", (str(request.url),)).fetchone()
+        if cached:
+            etag, last_modified, _, _ = cached
+            if etag:
+                request.headers["If-None-Match"] = etag
+            if last_modified:
+                request.headers["If-Modified-Since"] = last_modified
+
+    is_write = method != "GET" and TokenPool.resource(request) == "core"
+    # The scripts skip their writes in dry-run mode. This catches any they miss, before they change anything.
+    if is_write and options.dry_run:
+        raise RuntimeError(f"Refusing to send {method} {request.url} in dry-run mode")
+
+    await client.auth.wait_for_quota(request)
+    async with client.auth.write_limiter if is_write else contextlib.nullcontext(), api_semaphore:
+        response = await client.send(request)
+
+    if cached and response.status_code == 304:
+        logging.info("Cache hit: %s", request.url)
+        _, _, link, body = cached
+        return httpx.Response(200, headers={"Link": link} if link else None, content=body, request=request)
+
+    if response.is_success and is_rate_limited(response):
+        raise httpx.HTTPStatusError(f"GraphQL rate limit exceeded for url '{request.url}'", request=request, response=response)
+    response.raise_for_status()
+
+    if method == "GET" and ("ETag" in response.headers or "Last-Modified" in response.headers):
+        cache.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                      (str(request.url), response.headers.get("ETag"), response.headers.get("Last-Modified"),
+                       response.headers.get("Link"), response.content))
+        cache.commit()
+
+    return response
+
+
+async def gh_get(client: httpx.AsyncClient, path: str, **params):
+    return orjson.loads((await gh_request(client, "GET", path, params=params)).content)
+
+
+async def gh_post(client: httpx.AsyncClient, path: str, payload: dict):
+    return orjson.loads((await gh_request(client, "POST", path, content=orjson.dumps(payload), headers=JSON_HEADERS)).content)
+
+
+async def gh_patch(client: httpx.AsyncClient, path: str, payload: dict):
+    return orjson.loads((await gh_request(client, "PATCH", path, content=orjson.dumps(payload), headers=JSON_HEADERS)).content)
+
+
+async def gh_paginate(client: httpx.AsyncClient, path: str, **params) -> AsyncIterator[dict]:
+    """Yield every item from a paginated REST endpoint, following the Link header."""
+    url: Optional[str] = path
+    params.setdefault("per_page", 100)
+    while url:
+        response = await gh_request(client, "GET", url, params=params)
+        for item in orjson.loads(response.content):
+            yield item
+        # The next link already includes the query string
+        url = response.links.get("next", {}).get("url")
+        params = {}
+
+
+async def gh_graphql(client: httpx.AsyncClient, query: str, variables: dict) -> dict:
+    payload = orjson.loads((await gh_request(client, "POST", GRAPHQL_URL, content=orjson.dumps({"query": query, "variables": variables}), headers=JSON_HEADERS)).content)
+    if payload.get("errors"):
+        raise RuntimeError(f"GraphQL query failed: {payload['errors']}")
+    return payload["data"]
+
+
+async def repo_exists(client: httpx.AsyncClient, repo: str) -> bool:
+    try:
+        await gh_get(client, f"/repos/{repo}")
+        return True
+    except httpx.HTTPStatusError as e:
+        if e.response.status_code == 404:
+            return False
+        raise
+
+
+def done_key(*parts: str) -> str:
+    return hashlib.sha256("\n".join((options.dest_repo,) + parts).encode()).hexdigest()
+
+
+def is_done(key: str) -> bool:
+    return cache.execute("SELECT 1 FROM done WHERE k = ?", (key,)).fetchone() is not None
+
+
+def mark_done(key: str):
+    if options.dry_run:
+        return
+    cache.execute("INSERT OR IGNORE INTO done VALUES (?)", (key,))
+    cache.commit()
@@ -1,210 +1,366 @@
 import sys
+import os
+import asyncio
 import logging
 import argparse
-from typing import Optional, Union
-import github3
-from github3.repos.repo import Repository
-from github3.issues.issue import Issue
-from github3.pulls import PullRequest
+import bisect
+from typing import Optional
+import httpx
 
 parser = argparse.ArgumentParser(description="Migrate GitHub Releases from a private repo to a GHEC EMU instance.")
 parser.add_argument("--source-repo", required=True, help="Source GitHub repo (format: owner/repo)")
 parser.add_argument("--dest-repo", required=True, help="Destination GitHub repo (format: owner/repo)")
-parser.add_argument("--source-token", required=True, help="GitHub PAT for source repo")
-parser.add_argument("--dest-token", required=True, help="GitHub PAT for destination repo")
+parser.add_argument("--source-token", required=True, help="GitHub PAT for source repo, or a comma-separated list of PATs to rotate between")
+parser.add_argument("--dest-token", required=True, help="GitHub PAT for destination repo, or a comma-separated list of PATs to rotate between")
 parser.add_argument("--log-file", default="migration.log", help="Log file path (default: migration.log)")
-parser.add_argument("--max-threads", type=int, default=5, help="Number of concurrent threads for uploads/downloads (default: 5)")
+parser.add_argument("--max-threads", type=int, default=5, help="Maximum number of concurrent API requests (default: 5)")
+parser.add_argument("--cache-file", default=".reposync-cache.sqlite", help="File for caching GET responses and tracking completed writes between runs (default: .reposync-cache.sqlite)")
 parser.add_argument("--dry-run", action="store_true", help="Enable dry-run mode (no actual changes)")
 
 args = parser.parse_args()
 
-# Setup logging
-logging.basicConfig(
-    filename=args.log_file,
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s",
-)
-logging.getLogger().addHandler(logging.StreamHandler(sys.stdout))
-
-TEMP_DOWNLOAD_DIR = "release_assets"
-
-
-def get_issue_or_pr(repo: Repository, number: int) -> Optional[Union[Issue, PullRequest]]:
-    try:
-        pr = repo.pull_request(number)
-        if pr:
-            return pr
-    except Exception:
-        pass
-
-    try:
-        issue = repo.issue(number)
-        if issue:
-            return issue
-    except Exception:
-        pass
-
-    return None
-
-
-def create_issue(dest_repo: Repository, source_issue: Issue) -> Optional[Issue]:
-    try:
-        labels = [label for label in source_issue.labels()]
-
-        issue = dest_repo.create_issue(
-            title=source_issue.title,
-            body=source_issue.body or '',
-            labels=labels or None
-        )
-
-        assert issue, f"Failed to create issue #{source_issue.number} in destination repo"
-
-        # Add comments
-        for source_comment in source_issue.comments():
-            header = f"Originally written by {source_comment.user.login} on {source_comment.created_at.isoformat()} at {source_comment.url}"
-            issue.create_comment(body=header + "\n\n" + source_comment.body)
-        
-        # Update issue state if closed
-        if source_issue.state == 'closed':
-            issue.close()
-    
+# The API helpers shared with the other sync scripts live at the repo root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import github_api
+from github_api import create_client, gh_post, gh_patch, gh_paginate, gh_graphql, repo_exists, done_key, is_done, mark_done
+
+github_api.setup(args)
+
+# Walks issues and PRs side by side, one page of each per request. A connection is dropped from the
+# query via @include once it has been fully paged through. This only fetches enough to tell whether a
+# number is taken and by what; details are fetched separately, for only the items that need creating.
+ITEMS_QUERY = """
+query($owner: String!, $name: String!, $issuesCursor: String, $prsCursor: String, $fetchIssues: Boolean!, $fetchPRs: Boolean!) {
+    repository(owner: $owner, name: $name) {
+        issues(first: 100, after: $issuesCursor, states: [OPEN, CLOSED]) @include(if: $fetchIssues) {
+            pageInfo { endCursor hasNextPage }
+            nodes { number title }
+        }
+        pullRequests(first: 100, after: $prsCursor, states: [OPEN, CLOSED, MERGED]) @include(if: $fetchPRs) {
+            pageInfo { endCursor hasNextPage }
+            nodes { number title }
+        }
+    }
+}
+"""
+
+DETAILS_FRAGMENTS = """
+fragment IssueDetails on Issue {
+    number
+    title
+    body
+    state
+    labels(first: 20) { nodes { name } }
+    comments(first: 100) {
+        pageInfo { hasNextPage }
+        nodes { author { login } createdAt body url }
+    }
+}
+
+fragment PullRequestDetails on PullRequest {
+    number
+    title
+    body
+    state
+    baseRefName
+    headRefOid
+    comments(first: 100) {
+        pageInfo { hasNextPage }
+        nodes { author { login } createdAt body url }
+    }
+}
+"""
+
+# Number of items to fetch details for per GraphQL request. This keeps each request well within
+# GitHub's node limit, since every item can bring along 100 comments.
+DETAILS_BATCH_SIZE = 50
+
+
+async def fetch_items(client: httpx.AsyncClient, repo: str) -> dict[int, dict]:
+    """Fetch every issue and PR in the repo, keyed by number. Each item gets a "kind" of "issue" or "pr"."""
+    owner, name = repo.split("/")
+    items = {}
+    cursors = {"issues": None, "pullRequests": None}
+    has_next = {"issues": True, "pullRequests": True}
+
+    while has_next["issues"] or has_next["pullRequests"]:
+        repository = (await gh_graphql(client, ITEMS_QUERY, {
+            "owner": owner,
+            "name": name,
+            "issuesCursor": cursors["issues"],
+            "prsCursor": cursors["pullRequests"],
+            "fetchIssues": has_next["issues"],
+            "fetchPRs": has_next["pullRequests"],
+        }))["repository"]
+
+        for connection, kind in (("issues", "issue"), ("pullRequests", "pr")):
+            if not has_next[connection]:
+                continue
+            page = repository[connection]
+            for node in page["nodes"]:
+                node["kind"] = kind
+                items[node["number"]] = node
+            cursors[connection] = page["pageInfo"]["endCursor"]
+            has_next[connection] = page["pageInfo"]["hasNextPage"]
+
+    return items
+
+
+async def fetch_details_batch(client: httpx.AsyncClient, repo: str, numbers: list[int]) -> dict[int, dict]:
+    """Fetch the body, labels and comments of the specified issues/PRs in a single request."""
+    owner, name = repo.split("/")
+    aliases = "\n".join(f"i{number}: issueOrPullRequest(number: {number}) {{ ...IssueDetails ...PullRequestDetails }}"
+                        for number in numbers)
+    query = f"query($owner: String!, $name: String!) {{ repository(owner: $owner, name: $name) {{ {aliases} }} }}" + DETAILS_FRAGMENTS
+    repository = (await gh_graphql(client, query, {"owner": owner, "name": name}))["repository"]
+    return {number: repository[f"i{number}"] for number in numbers}
+
+
+def comment_header(author: Optional[dict], created_at: str, url: str) -> str:
+    return f"Originally written by {author['login'] if author else 'ghost'} on {created_at} at {url}"
+
+
+async def get_comments(source: httpx.AsyncClient, source_item: dict) -> list[tuple[str, str]]:
+    """Get the creation time and body (with attribution header) of each comment to post for an issue or PR."""
+    comments = source_item["comments"]
+    if not comments["pageInfo"]["hasNextPage"]:
+        return [(comment["createdAt"], comment_header(comment["author"], comment["createdAt"], comment["url"]) + "\n\n" + comment["body"])
+                for comment in comments["nodes"]]
+
+    # More comments than fit in the bulk query, so fall back to REST for the full list
+    return [(comment["created_at"], comment_header(comment["user"], comment["created_at"], comment["html_url"]) + "\n\n" + comment["body"])
+            async for comment in gh_paginate(source, f"/repos/{args.source_repo}/issues/{source_item['number']}/comments")]
+
+
+async def get_review_comments(source: httpx.AsyncClient, source_pr: dict) -> list[tuple[str, dict]]:
+    """Get the creation time and payload (with attribution header) of each review comment to post for a PR."""
+    # Review comments need the commit/path/position details that only REST provides
+    return [(comment["created_at"], {
+                "body": comment_header(comment["user"], comment["created_at"], comment["html_url"]) + "\n\n" + comment["body"],
+                "commit_id": comment["commit_id"],
+                "path": comment["path"],
+                "position": comment["position"],
+            })
+            async for comment in gh_paginate(source, f"/repos/{args.source_repo}/pulls/{source_pr['number']}/comments")]
+
+
+async def add_comment(dest: httpx.AsyncClient, number: int, body: str):
+    # The header includes the source comment's URL, so the body identifies the comment
+    key = done_key("comment", str(number), body)
+    if is_done(key):
+        return
+    if args.dry_run:
+        logging.info("[DRY-RUN] #%d: Would add comment", number)
+        return
+    await gh_post(dest, f"/repos/{args.dest_repo}/issues/{number}/comments", {"body": body})
+    mark_done(key)
+
+
+async def add_review_comment(dest: httpx.AsyncClient, number: int, review_comment: dict):
+    key = done_key("review comment", str(number), review_comment["body"])
+    if is_done(key):
+        return
+    if args.dry_run:
+        logging.info("[DRY-RUN] #%d: Would add review comment", number)
+        return
+    await gh_post(dest, f"/repos/{args.dest_repo}/pulls/{number}/comments", review_comment)
+    mark_done(key)
+
+
+async def finish_issue(source: httpx.AsyncClient, dest: httpx.AsyncClient, number: int, source_issue: dict):
+    """Add the comments and state to an issue that has been created in the destination repo."""
+    # Add comments
+    for _, body in await get_comments(source, source_issue):
+        await add_comment(dest, number, body)
+
+    # Update issue state if closed
+    if source_issue["state"] == 'CLOSED':
+        if args.dry_run:
+            logging.info("[DRY-RUN] #%d: Would close issue", number)
+        else:
+            await gh_patch(dest, f"/repos/{args.dest_repo}/issues/{number}", {"state": "closed"})
+
+    mark_done(done_key("finished", str(number)))
+
+
+async def finish_pr(source: httpx.AsyncClient, dest: httpx.AsyncClient, number: int, source_pr: dict):
+    """Add the comments and state to a PR that has been created in the destination repo."""
+    # Fetch both kinds of comments concurrently, then add them one at a time in the order they were
+    # originally written so that the PR's timeline reads the same as in the source repo
+    comments, review_comments = await asyncio.gather(get_comments(source, source_pr), get_review_comments(source, source_pr))
+    timeline = ([(created_at, add_comment, body) for created_at, body in comments] +
+                [(created_at, add_review_comment, review_comment) for created_at, review_comment in review_comments])
+    for _, add, content in sorted(timeline, key=lambda entry: entry[0]):
+        await add(dest, number, content)
+
+    # Update PR state if closed (merged PRs can't be merged in the destination, so close them too)
+    if source_pr["state"] != 'OPEN':
+        if args.dry_run:
+            logging.info("[DRY-RUN] #%d: Would close PR", number)
+        else:
+            await gh_patch(dest, f"/repos/{args.dest_repo}/pulls/{number}", {"state": "closed"})
+
+    mark_done(done_key("finished", str(number)))
+
+
+async def create_issue(source: httpx.AsyncClient, dest: httpx.AsyncClient, source_issue: dict) -> dict:
+    labels = [label["name"] for label in source_issue["labels"]["nodes"]]
+
+    if args.dry_run:
+        logging.info("[DRY-RUN] #%d: Would create issue", source_issue['number'])
+        issue = {"number": source_issue["number"]}  # Simulated issue
+        await finish_issue(source, dest, issue["number"], source_issue)
         return issue
-    except Exception as e:
-        print(f"Error creating issue #{source_issue.number}: {e}")
-        return None
-
-def create_pr(dest_repo: Repository, source_pr: PullRequest) -> Optional[PullRequest]:
-    try:
-        # dest_repo.create_branch_ref(name=f"migrate_pr_{source_pr.number}", sha=source_pr.head.sha)
-
-        # What to pass for the head? When looking at my source repo, I found examples where the source PR's
-        # head was not a fork branch, but the branch was regularly deleted and recreated, so even if it does
-        # exist, we wouldn't want to use the existing branch here. We could also use the head commit SHA from
-        # the source PR, but in the case of PRs from forks, that commit may not exist in the source repo.
-
-        pr = dest_repo.create_pull(
-            title=source_pr.title,
-            base=source_pr.base.ref,
-            head=source_pr.head.sha,
-            body=source_pr.body or ''
-        )
-        
-        assert pr, f"Failed to create PR #{source_pr.number} in destination repo"
-
-        # Add comments
-        for source_comment in source_pr.issue_comments():
-            header = f"Originally written by {source_comment.user.login} on {source_comment.created_at.isoformat()} at {source_comment.url}"
-            pr.create_comment(body=header + "\n\n" + source_comment.body)
-
-        # Add review comments
-        for source_review_comment in source_pr.review_comments():
-            header = f"Originally written by {source_review_comment.user.login} on {source_review_comment.created_at.isoformat()} at {source_review_comment.url}"
-            pr.create_review_comment(body=header + "\n\n" + source_review_comment.body,
-                                     commit_id=source_review_comment.commit_id,
-                                     path=source_review_comment.path,
-                                     position=source_review_comment.position)
-
-        # Update PR state if closed
-        if source_pr.state == 'closed':
-            pr.close()
 
+    # Recorded up front, because a failed request may still have created the issue. If it did, a re-run finishes
+    # it rather than skipping it; requests that might have created something aren't retried, to avoid duplicates.
+    mark_done(done_key("created", str(source_issue["number"])))
+
+    issue = await gh_post(dest, f"/repos/{args.dest_repo}/issues", {
+        "title": source_issue["title"],
+        "body": source_issue["body"] or '',
+        "labels": labels,
+    })
+
+    assert issue, f"Failed to create issue #{source_issue['number']} in destination repo"
+
+    await finish_issue(source, dest, issue["number"], source_issue)
+
+    return issue
+
+async def create_pr(source: httpx.AsyncClient, dest: httpx.AsyncClient, source_pr: dict) -> dict:
+    # await gh_post(dest, f"/repos/{args.dest_repo}/git/refs", {"ref": f"refs/heads/migrate_pr_{source_pr['number']}", "sha": source_pr["headRefOid"]})
+
+    # What to pass for the head? When looking at my source repo, I found examples where the source PR's
+    # head was not a fork branch, but the branch was regularly deleted and recreated, so even if it does
+    # exist, we wouldn't want to use the existing branch here. We could also use the head commit SHA from
+    # the source PR, but in the case of PRs from forks, that commit may not exist in the source repo.
+
+    if args.dry_run:
+        logging.info("[DRY-RUN] #%d: Would create PR", source_pr['number'])
+        pr = {"number": source_pr["number"]}  # Simulated PR
+        await finish_pr(source, dest, pr["number"], source_pr)
         return pr
-    except Exception as e:
-        print(f"Error creating PR #{source_pr.number}: {e}")
-        return None
-
-
-def migrate_labels(source_repo: Repository, dest_repo: Repository):
-    try:
-        source_labels = source_repo.labels()
-        for label in source_labels:
-            try:
-                dest_repo.label(label.name)
-            except github3.exceptions.NotFoundError:
-                dest_repo.create_label(label.name, label.color)
-    except Exception as e:
-        assert False, f"Error migrating labels: {e}"
-
-
-def migrate_issues(max_number: Optional[int] = None):
-    source_gh = github3.GitHub("https://github.com/{args.source_repo}", token=args.source_token)
-    source_components = args.source_repo.split("/")
-    source_repo = source_gh.repository(source_components[0], source_components[1])
-    if not source_repo:
-        logging.error(f"❌ Source repository {args.source_repo} not found.")
+
+    # Recorded up front for the same reason as in create_issue
+    mark_done(done_key("created", str(source_pr["number"])))
+
+    pr = await gh_post(dest, f"/repos/{args.dest_repo}/pulls", {
+        "title": source_pr["title"],
+        "base": source_pr["baseRefName"],
+        "head": source_pr["headRefOid"],
+        "body": source_pr["body"] or '',
+    })
+    
+    assert pr, f"Failed to create PR #{source_pr['number']} in destination repo"
+
+    await finish_pr(source, dest, pr["number"], source_pr)
+
+    return pr
+
+
+async def migrate_labels(source: httpx.AsyncClient, dest: httpx.AsyncClient):
+    # Label names are case-insensitive on GitHub
+    dest_label_names = {label["name"].lower() async for label in gh_paginate(dest, f"/repos/{args.dest_repo}/labels")}
+    async for label in gh_paginate(source, f"/repos/{args.source_repo}/labels"):
+        if label["name"].lower() not in dest_label_names:
+            if args.dry_run:
+                logging.info("[DRY-RUN] Would create label: %s", label['name'])
+                continue
+            await gh_post(dest, f"/repos/{args.dest_repo}/labels", {"name": label["name"], "color": label["color"]})
+
+
+async def migrate_issues(source: httpx.AsyncClient, dest: httpx.AsyncClient, max_number: Optional[int] = None):
+    if not await repo_exists(source, args.source_repo):
+        logging.error("❌ Source repository %s not found.", args.source_repo)
         return
 
-    dest_gh = github3.GitHub("https://github.com/{args.dest_repo}", token=args.dest_token)
-    dest_components = args.dest_repo.split("/")
-    dest_repo = dest_gh.repository(dest_components[0], dest_components[1])
-    if not dest_repo:
-        logging.error(f"❌ Destination repository {args.dest_repo} not found.")
+    if not await repo_exists(dest, args.dest_repo):
+        logging.error("❌ Destination repository %s not found.", args.dest_repo)
         return
 
-    migrate_labels(source_repo, dest_repo)
+    await migrate_labels(source, dest)
 
-    # Get all issues/PRs from source repo
-    source_issue_and_pr_numbers = [issue.number for issue in source_repo.issues(state='all')]
-    next_source_number = max(source_issue_and_pr_numbers) + 1 if source_issue_and_pr_numbers else 1
+    # Fetch all issues/PRs from both repos up front so the loop below doesn't need to query per number
+    source_items, dest_existing = await asyncio.gather(fetch_items(source, args.source_repo),
+                                                       fetch_items(dest, args.dest_repo))
+    # The highest number falls out of the page walk, so there's no need for a separate scan to find it
+    max_number = max_number or max(source_items, default=0)
 
-    logging.info(f"Syncing issues/PRs from {source_repo} to {dest_repo}")
-    logging.info(f"Processing numbers 1 through {max_number}")
+    # Items that this script created (or tried to) on an earlier run, but which failed before all of their comments were added
+    unfinished = {number for number in dest_existing
+                  if is_done(done_key("created", str(number))) and not is_done(done_key("finished", str(number)))}
 
-    # Turn down github3 logging verobosity
-    logging.getLogger('github3').setLevel(logging.CRITICAL)
+    # Details of the items that need creating or finishing are fetched in batches, just ahead of when they're needed
+    needs_details = [number for number in sorted(source_items)
+                    if number <= max_number and (number not in dest_existing or number in unfinished)]
+    details: dict[int, dict] = {}
+
+    logging.info("Syncing issues/PRs from %s to %s", args.source_repo, args.dest_repo)
+    logging.info("Processing numbers 1 through %s", max_number)
 
     # Process each number in sequence to ensure we handle both issues and PRs
-    for number in range(1, next_source_number):
+    for number in range(1, max_number + 1):
         # Get source item (issue or PR)
-        source_item = get_issue_or_pr(source_repo, number)
+        source_item = source_items.get(number)
         if not source_item:
-            print(f"#{number}: Not found in source repo - skipping")
+            logging.info("#%d: Not found in source repo - skipping", number)
             continue
 
-        if source_item.number != number:
-            print(f"#{number}: Number mismatch: {source_item.number} != {number} -- {source_item.url}")
-            continue
-            
         # Check if item exists in destination repo
-        dest_item = get_issue_or_pr(dest_repo, number)
+        dest_item = dest_existing.get(number)
 
-        if isinstance(source_item, PullRequest):
+        if not dest_item or number in unfinished:
+            if number not in details:
+                start = bisect.bisect_left(needs_details, number)
+                details.update(await fetch_details_batch(source, args.source_repo, needs_details[start:start + DETAILS_BATCH_SIZE]))
+            source_item = {**source_item, **details.pop(number)}
+
+        if source_item["kind"] == "pr":
             # Handle PR (as issue with placeholder)
             if dest_item:
                 # PR number exists in destination - update if it's a placeholder issue
-                if isinstance(dest_item, PullRequest):
-                    if source_item.title == dest_item.title:
-                        print(f"#{number}: PR exists in destination - skipping")
+                if dest_item["kind"] == "pr":
+                    if source_item["title"] == dest_item["title"]:
+                        if number in unfinished:
+                            logging.info("#%d: Finishing partially created PR", number)
+                            await finish_pr(source, dest, number, source_item)
+                        else:
+                            logging.info("#%d: PR exists in destination - skipping", number)
                     else:
-                        print(f"#{number}: WARNING: PR title mismatch - skipping")
-                elif isinstance(dest_item, Issue):
-                    print(f"#{number}: WARNING: Source is PR, destination is issue - skipping")
+                        logging.warning("#%d: WARNING: PR title mismatch - skipping", number)
                 else:
-                    assert False, f"Unknown type for destination item #{number}: {type(dest_item)}"
+                    logging.warning("#%d: WARNING: Source is PR, destination is issue - skipping", number)
             else:
-                print(f"#{number}: Creating PR")
-                placeholder = create_pr(dest_repo, source_item)
+                logging.info("#%d: Creating PR", number)
+                placeholder = await create_pr(source, dest, source_item)
                 assert placeholder, f"Failed to create placeholder PR for #{number}"
-                assert placeholder.number == number, f"Placeholder PR number mismatch: {placeholder.number} != {number}"
-        elif isinstance(source_item, Issue):
+                assert placeholder["number"] == number, f"Placeholder PR number mismatch: {placeholder['number']} != {number}"
+        else:
             if dest_item:
-                if isinstance(dest_item, Issue):
-                    if source_item.title == dest_item.title:
-                        print(f"#{number}: Issue exists in destination - skipping")
+                if dest_item["kind"] == "issue":
+                    if source_item["title"] == dest_item["title"]:
+                        if number in unfinished:
+                            logging.info("#%d: Finishing partially created issue", number)
+                            await finish_issue(source, dest, number, source_item)
+                        else:
+                            logging.info("#%d: Issue exists in destination - skipping", number)
                     else:
-                        print(f"#{number}: WARNING: Issue title mismatch - skipping")
-                elif isinstance(dest_item, PullRequest):
-                    print(f"#{number}: WARNING: Source is issue, destination is PR - skipping")
+                        logging.warning("#%d: WARNING: Issue title mismatch - skipping", number)
                 else:
-                    assert False, f"Unknown type for destination item #{number}: {type(dest_item)}"
+                    logging.warning("#%d: WARNING: Source is issue, destination is PR - skipping", number)
             else:
-                print(f"#{number}: Creating new issue")
-                issue = create_issue(dest_repo, source_item)
+                logging.info("#%d: Creating new issue", number)
+                issue = await create_issue(source, dest, source_item)
                 assert issue, f"Failed to create issue for #{number}"
-                assert issue.number == number, f"Issue number mismatch: {issue.number} != {number}"
-        else:
-            assert False, f"Unknown type for source item #{number}: {type(source_item)}"
+                assert issue["number"] == number, f"Issue number mismatch: {issue['number']} != {number}"
+
+
+async def main():
+    # One client per side for the whole run, so connections are reused across every request
+    async with create_client(args.source_token) as source, create_client(args.dest_token) as dest:
+        await migrate_issues(source, dest)
 
 
 if __name__ == "__main__":
-    migrate_issues()
+    asyncio.run(main())
@@ -1,132 +1,172 @@
 import sys
 import os
+import asyncio
 import logging
 import argparse
-import github3
+import httpx
 
 parser = argparse.ArgumentParser(description="Migrate GitHub Releases from a private repo to a GHEC EMU instance.")
 parser.add_argument("--source-repo", required=True, help="Source GitHub repo (format: owner/repo)")
 parser.add_argument("--dest-repo", required=True, help="Destination GitHub repo (format: owner/repo)")
-parser.add_argument("--source-token", required=True, help="GitHub PAT for source repo")
-parser.add_argument("--dest-token", required=True, help="GitHub PAT for destination repo")
+parser.add_argument("--source-token", required=True, help="GitHub PAT for source repo, or a comma-separated list of PATs to rotate between")
+parser.add_argument("--dest-token", required=True, help="GitHub PAT for destination repo, or a comma-separated list of PATs to rotate between")
 parser.add_argument("--log-file", default="migration.log", help="Log file path (default: migration.log)")
-parser.add_argument("--max-threads", type=int, default=5, help="Number of concurrent threads for uploads/downloads (default: 5)")
+parser.add_argument("--max-threads", type=int, default=5, help="Maximum number of concurrent API requests, and separately of concurrent asset transfers (default: 5)")
+parser.add_argument("--cache-file", default=".reposync-cache.sqlite", help="File for caching GET responses and tracking completed writes between runs (default: .reposync-cache.sqlite)")
 parser.add_argument("--dry-run", action="store_true", help="Enable dry-run mode (no actual changes)")
 
 args = parser.parse_args()
 
-# Setup logging
-logging.basicConfig(
-    filename=args.log_file,
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s",
-)
-logging.getLogger().addHandler(logging.StreamHandler(sys.stdout))
+# The API helpers shared with the other sync scripts live at the repo root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import github_api
+from github_api import create_client, gh_request, gh_post, gh_paginate, repo_exists, done_key, is_done, mark_done, retry_transient
 
-TEMP_DOWNLOAD_DIR = "release_assets"
+github_api.setup(args)
 
-def create_release(dest_repo, source_release):
-    if args.dry_run:
-        logging.info(f"[DRY-RUN] Would create release: {source_release.name}")
-        return {"upload_url": "mock_url"}  # Simulated upload URL
+CHUNK_SIZE = 1 << 20
 
-    return dest_repo.create_release(tag_name=source_release.tag_name,
-                                    target_commitish=source_release.target_commitish,
-                                    name=source_release.name,
-                                    body=source_release.body or "",
-                                    draft=source_release.draft,
-                                    prerelease=source_release.prerelease)
+CONTENT_TYPES = {
+    ".zip": "application/zip",
+    ".vsix": "application/zip",
+    ".tgz": "application/gzip",
+    ".json": "application/json",
+    ".manifest": "application/manifest+json",
+    ".p7s": "application/pkcs7-signature",
+}
 
+# Asset transfers go to the asset storage and uploads.github.com hosts, which are rate limited separately
+# from the core API. They get their own limit so that long transfers don't starve the API calls.
+asset_semaphore = asyncio.Semaphore(args.max_threads)
 
-def download_asset(asset):
-    if args.dry_run:
-        logging.info(f"[DRY-RUN] Would download asset: {asset.name}")
-        return f"mock_path/{asset.name}"
-    
-    logging.info(f"Downloading asset: {asset.name} (size: {asset.size} bytes)")
 
-    download_dir = os.path.join(TEMP_DOWNLOAD_DIR, str(asset.id))
-    os.makedirs(download_dir, exist_ok=True)
-    local_path = os.path.join(download_dir, asset.name)
+async def create_release(dest, source_release):
+    if args.dry_run:
+        logging.info("[DRY-RUN] Would create release: %s", source_release['name'])
+        return {"upload_url": "mock_url"}  # Simulated upload URL
 
-    asset.download(local_path)
+    # Recorded up front, because a failed request may still have created the release. If it did, a re-run
+    # finishes it rather than skipping it.
+    mark_done(done_key("created", source_release["url"]))
 
-    logging.info(f"✅ Downloaded asset: {asset.name}")
-    return local_path
+    release = await gh_post(dest, f"/repos/{args.dest_repo}/releases", {
+        "tag_name": source_release["tag_name"],
+        "target_commitish": source_release["target_commitish"],
+        "name": source_release["name"],
+        "body": source_release["body"] or "",
+        "draft": source_release["draft"],
+        "prerelease": source_release["prerelease"],
+    })
+    return release
 
 
 def get_content_type(file_name):
     """Get the content type based on the file extension"""
     _, ext = os.path.splitext(file_name)
-    if ext == ".zip" or ext == ".vsix":
-        return "application/zip"
-    elif ext == ".tgz":
-        return "application/gzip"
-    elif ext == ".json":
-        return "application/json"
-    elif ext == ".manifest":
-        return "application/manifest+json"
-    elif ext == ".p7s":
-        return "application/pkcs7-signature"
-    else:
-        return "application/octet-stream"
-
-
-def upload_asset(target_release, file_path):
-    """Upload the specified file as an asset attached to the specified release."""
-    if args.dry_run:
-        logging.info(f"[DRY-RUN] Would upload asset: {file_path}")
-        return
-
-    logging.info(f"Uploading asset: {file_path}")
+    return CONTENT_TYPES.get(ext.lower(), "application/octet-stream")
 
-    file_name = os.path.basename(file_path)
 
-    with open(file_path, 'rb') as file_obj:
-        target_release.upload_asset(content_type=get_content_type(file_name), name=file_name, asset=file_obj)
-
-    logging.info(f"✅ Uploaded asset: {file_name}")
+@retry_transient
+async def transfer_asset(source, dest, asset, target_release):
+    """Stream the specified asset from the source repo into the specified release, without touching disk."""
+    if args.dry_run:
+        logging.info("[DRY-RUN] Would transfer asset: %s", asset['name'])
+        return
 
+    key = done_key("asset", asset["url"])
+    if is_done(key):
+        logging.info("⏭️ Skipping already transferred asset: %s", asset['name'])
+        return
 
-def migrate_releases():
-    source_gh = github3.GitHub("https://github.com/{args.source_repo}", token=args.source_token)
-    source_components = args.source_repo.split("/")
-    source_repo = source_gh.repository(source_components[0], source_components[1])
-    if not source_repo:
-        logging.error(f"❌ Source repository {args.source_repo} not found.")
+    logging.info("Transferring asset: %s (size: %d bytes)", asset['name'], asset['size'])
+
+    # upload_url is a URI template ending in "{?name,label}"
+    upload_url = target_release["upload_url"].split("{")[0]
+
+    # The API URL (unlike browser_download_url) works for private repos. It redirects to the asset
+    # storage host, and httpx drops the Authorization header when following that redirect. The bytes
+    # are copied exactly as stored, since the upload declares the asset's size as its Content-Length.
+    async with dest.auth.write_limiter, asset_semaphore:
+        async with source.stream("GET", asset["url"], headers={"Accept": "application/octet-stream", "Accept-Encoding": "identity"}) as download:
+            download.raise_for_status()
+            response = await dest.post(upload_url,
+                                       params={"name": asset["name"]},
+                                       headers={
+                                           "Content-Type": get_content_type(asset["name"]),
+                                           "Content-Length": str(asset["size"]),
+                                       },
+                                       content=download.aiter_raw(CHUNK_SIZE))
+    response.raise_for_status()
+    mark_done(key)
+
+    logging.info("✅ Transferred asset: %s", asset['name'])
+
+
+async def uploaded_asset_names(dest, release) -> set[str]:
+    """Get the names of the assets that have been fully uploaded to the release, deleting any upload that was cut off.
+
+    The ledger can't be relied on for this, because an upload may have reached GitHub without the run recording it.
+    Uploading that asset again would fail, since GitHub doesn't allow two assets with the same name."""
+    names = set()
+    async for asset in gh_paginate(dest, f"/repos/{args.dest_repo}/releases/{release['id']}/assets"):
+        if asset["state"] == "uploaded":
+            names.add(asset["name"])
+        elif args.dry_run:
+            logging.info("[DRY-RUN] Would delete incomplete asset: %s", asset['name'])
+        else:
+            logging.info("🗑️ Deleting incomplete asset: %s", asset['name'])
+            await gh_request(dest, "DELETE", f"/repos/{args.dest_repo}/releases/assets/{asset['id']}")
+    return names
+
+
+async def migrate_releases(source: httpx.AsyncClient, dest: httpx.AsyncClient):
+    if not await repo_exists(source, args.source_repo):
+        logging.error("❌ Source repository %s not found.", args.source_repo)
         return
 
-    dest_gh = github3.GitHub("https://github.com/{args.dest_repo}", token=args.dest_token)
-    dest_components = args.dest_repo.split("/")
-    dest_repo = dest_gh.repository(dest_components[0], dest_components[1])
-    if not dest_repo:
-        logging.error(f"❌ Destination repository {args.dest_repo} not found.")
+    if not await repo_exists(dest, args.dest_repo):
+        logging.error("❌ Destination repository %s not found.", args.dest_repo)
         return
 
-    release_names_in_destination_repo = [release.name for release in dest_repo.releases()]
-    releases_in_source_repo = list(source_repo.releases())
+    releases_in_destination_repo = {release["name"]: release async for release in gh_paginate(dest, f"/repos/{args.dest_repo}/releases")}
+    releases_in_source_repo = [release async for release in gh_paginate(source, f"/repos/{args.source_repo}/releases")]
 
     for source_release in releases_in_source_repo:
-        logging.info(f"🚀 Processing release: {source_release.name}")
-
-        if source_release.name in release_names_in_destination_repo:
-            logging.info(f"⏭️ Skipping existing release: {source_release.name}")
-            continue
-
-        new_release = create_release(dest_repo, source_release)
-        if not new_release:
-            logging.error(f"❌ Failed to create release {source_release.name} in destination repo.")
-            continue
-
-        # Asset download/upload is intentionally not parallelized to avoid hitting GitHub API rate limits
-        source_assets = list(source_release.assets())
-        downloaded_files = [download_asset(asset) for asset in source_assets]
-        logging.info(f"All assets for release {source_release.name} downloaded.")
-
-        for file_path in downloaded_files:
-            upload_asset(new_release, file_path)
+        logging.info("🚀 Processing release: %s", source_release['name'])
+
+        if source_release["name"] in releases_in_destination_repo:
+            # A release this script created (or tried to) on an earlier run, which failed before all of its assets were transferred
+            if is_done(done_key("created", source_release["url"])) and not is_done(done_key("finished", source_release["url"])):
+                logging.info("⏯️ Finishing partially transferred release: %s", source_release['name'])
+                new_release = releases_in_destination_repo[source_release["name"]]
+                uploaded = await uploaded_asset_names(dest, new_release)
+            else:
+                logging.info("⏭️ Skipping existing release: %s", source_release['name'])
+                continue
+        else:
+            new_release = await create_release(dest, source_release)
+            if not new_release:
+                logging.error("❌ Failed to create release %s in destination repo.", source_release['name'])
+                continue
+            uploaded = set()
+
+        # Releases are created one at a time to preserve their order, but their assets are transferred concurrently
+        source_assets = [asset async for asset in gh_paginate(source, f"/repos/{args.source_repo}/releases/{source_release['id']}/assets")]
+        for asset in source_assets:
+            if asset["name"] in uploaded:
+                mark_done(done_key("asset", asset["url"]))
+        await asyncio.gather(*(transfer_asset(source, dest, asset, new_release) for asset in source_assets))
+
+        mark_done(done_key("finished", source_release["url"]))
+
+        logging.info("All assets for release %s transferred.", source_release['name'])
+
+
+async def main():
+    # Source and destination each keep a single client (and connection pool) for the whole run
+    async with create_client(args.source_token) as source, create_client(args.dest_token) as dest:
+        await migrate_releases(source, dest)
 
-        logging.info(f"All assets for release {source_release.name} uploaded.")
 
 if __name__ == "__main__":
-    migrate_releases()
+    asyncio.run(main())